@@ -0,0 +1,68 @@
+"""Startup time benchmark.
+
+Measures, each in a fresh process:
+
+    import          time to import selfhosting, paid by every CLI command
+    first-request   time to import the webapp and serve its first response
+
+and exits with status 1 if the median of either is above its limit.
+
+Usage:
+
+    python bench_startup.py [--runs N] [--max-import SECONDS] [--max-first-request SECONDS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+BENCHMARKS = {
+    "import": """
+import time
+start = time.perf_counter()
+import selfhosting
+print(time.perf_counter() - start)
+""",
+    "first-request": """
+import time
+start = time.perf_counter()
+from selfhosting import app
+response = app.test_client().get("/login")
+assert response.status_code == 200, response.status_code
+print(time.perf_counter() - start)
+""",
+}
+
+
+def measure(code, runs):
+    root = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root, text=True)
+        timings.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Startup time benchmark")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--max-import", type=float, default=0.15)
+    p.add_argument("--max-first-request", type=float, default=0.45)
+    args = p.parse_args()
+
+    limits = {"import": args.max_import, "first-request": args.max_first_request}
+
+    failed = False
+    for name, code in BENCHMARKS.items():
+        seconds = measure(code, args.runs)
+        ok = seconds <= limits[name]
+        failed = failed or not ok
+        print(f"{name:15} {seconds * 1000:8.1f} ms  (limit {limits[name] * 1000:.0f} ms)  {'ok' if ok else 'FAIL'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
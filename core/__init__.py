@@ -1,32 +1,32 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
-from typing import Any, Dict, Type
-
-import requests
-import yaml
-from flask import g
+from typing import Any, Dict, List, Tuple, Type
 
+from . import stats
 from .db import Site
-from .tasks import TaskParser, TaskStatus, ValidationError, Validator
+from .tasks import CheckStatus, TaskParser, TaskStatus, ValidationError, Validator, load_yaml
 
 
 class Treadmill:
     def __init__(self, app, tasks_file):
         """Treadmill instance.
 
-        app: Flask app
+        app: Flask app, or None to attach it later with init_app
         tasks_file: Path to YAML file with tasks
         """
         self.tasks_file = tasks_file
 
-        @app.before_request
-        def on_request():
-            g.treadmill = self
+        self._apps = []
+        if app is not None:
+            self.init_app(app)
 
         props = self.load_properties(self.tasks_file)
         self.title = props["title"]
         self.subtitle = props.get("subtitle", "")
 
         self.config = self.load_config(self.tasks_file)
+        self._base_urls = {}
 
         self._validators = {}
         self._tasks = None  # hidden because we want to lazy-load with get_tasks()
@@ -35,6 +35,23 @@ class Treadmill:
         self.validator(check_not_implemented)
         self.validator(check_webpage_content)
 
+    def is_attached(self, app):
+        return app in self._apps
+
+    def init_app(self, app):
+        """Attach the treadmill to a Flask app. Safe to call more than once.
+        """
+        if self.is_attached(app):
+            return
+
+        from flask import g
+
+        @app.before_request
+        def on_request():
+            g.treadmill = self
+
+        self._apps.append(app)
+
     def validator(self, klass: Type[Validator]):
         """Class decorator to add a class as a Validator
         """
@@ -43,16 +60,14 @@ class Treadmill:
 
     def set_config(self, key, value):
         self.config[key] = value
+        self._base_urls.clear()
 
     def load_config(self, path):
-        with open(path) as f:
-            config = yaml.safe_load(f).get("config", {})
-
+        config = dict(load_yaml(path).get("config", {}))
         return config
 
     def load_properties(self, path):
-        with open(path) as f:
-            props = yaml.safe_load(f)
+        props = dict(load_yaml(path))
 
         # discard keys tasks and config if they exist
         props.pop("tasks", None)
@@ -77,27 +92,99 @@ class Treadmill:
         parser = TaskParser(self.tasks_file, self._validators)
         return parser.load_from_file(self.tasks_file)
 
-    def get_status(self, site):
+    def get_status(self, site, speculate=None, full=None):
         """Get status of site by running all validators
 
+        A task is evaluated once all the tasks it depends on have passed,
+        and all the tasks that are ready are evaluated concurrently. By
+        default every task depends on the previous one, which evaluates
+        the tasks in order and stops at the first task that doesn't pass.
+
+        With speculate=K (or config speculative_tasks: K), up to K tasks
+        whose dependencies are still being evaluated are evaluated along
+        with them. Their results are discarded if the dependencies don't
+        pass.
+
         Return value is a dict with keys:
-        {tasks: Dict[str, TaskStatus], current_task: str}
-        """
-        evaluator = Evaluator(site, config=self.config)
+        {tasks: Dict[str, TaskStatus], current_task: str, frontier: List[str]}
 
-        tasks = {}
-        for task in self.get_tasks():
-            task_status = evaluator.evaluate_task(task)
-            tasks[task.name] = asdict(task_status)
-            if task_status.status != TaskStatus.PASS:
-                break
+        frontier is the list of evaluated tasks that didn't pass, and
+        current_task is the first of them (or the last task when all pass).
 
-        return dict(tasks=tasks, current_task=task.name)
+        With full=False (or config fail_fast: true), the remaining checks
+        of a task are skipped once one of them fails. See Evaluator.
+        """
+        if full is None:
+            full = not self.config.get("fail_fast", False)
+        evaluator = Evaluator(site, config=self.config, full=full)
+        if speculate is None:
+            speculate = self.config.get("speculative_tasks", 0)
+        max_workers = self.config.get("max_parallel_tasks", 8)
+
+        all_tasks = self.get_tasks()
+        statuses = {}  # task name -> TaskStatus
+        passed = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                batch = [t for t in all_tasks
+                         if t.name not in statuses and passed.issuperset(t.depends_on)]
+                if not batch:
+                    break
+
+                # speculate on the tasks that would be ready if this batch passes
+                scheduled = passed | {t.name for t in batch}
+                speculative = []
+                for t in all_tasks:
+                    if len(speculative) >= speculate:
+                        break
+                    if (t.name not in scheduled and t.name not in statuses
+                            and scheduled.issuperset(t.depends_on)):
+                        speculative.append(t)
+                        scheduled.add(t.name)
+                batch += speculative
+
+                if len(batch) == 1:
+                    results = [evaluator.evaluate_task(batch[0])]
+                else:
+                    results = list(executor.map(evaluator.evaluate_task, batch))
+
+                # accept the results of the tasks whose dependencies passed,
+                # in dependency order. Only accepted results are recorded.
+                pending = dict(zip([t.name for t in batch], zip(batch, results)))
+                accepted = True
+                while accepted:
+                    accepted = False
+                    for name, (task, (task_status, runs, durations)) in list(pending.items()):
+                        if passed.issuperset(task.depends_on):
+                            stats.record_task_run(site, name, runs, durations)
+                            statuses[name] = task_status
+                            if task_status.status == TaskStatus.PASS:
+                                passed.add(name)
+                            del pending[name]
+                            accepted = True
+
+        tasks = {t.name: asdict(statuses[t.name]) for t in all_tasks if t.name in statuses}
+        frontier = [name for name in tasks if name not in passed]
+        current_task = frontier[0] if frontier else all_tasks[-1].name
+        return dict(tasks=tasks, current_task=current_task, frontier=frontier)
+
+    def get_frontier(self, statuses):
+        """Returns the names of the tasks that are ready to be worked on,
+        i.e. haven't passed but all the tasks they depend on have.
+
+        statuses: dict of task name -> status, of the evaluated tasks
+        """
+        return [task.name for task in self.get_tasks()
+                if statuses.get(task.name) != TaskStatus.PASS
+                and all(statuses.get(name) == TaskStatus.PASS for name in task.depends_on)]
 
     def _get_base_url(self, site_name):
         """Get base URL for a site from its name
         """
-        return self.config["base_url"].format(name=site_name)
+        if site_name not in self._base_urls:
+            self._base_urls[site_name] = self.config["base_url"].format(name=site_name)
+        return self._base_urls[site_name]
 
     def _patch_site(self, site):
         """Any post-processing for a site, after it is fetched from DB
@@ -112,6 +199,13 @@ class Treadmill:
         site = Site.create(name, current_task=current_task.name)
         return self._patch_site(site)
 
+    def get_or_create_site(self, name):
+        """Get the site with the given name, creating it if it doesn't exist
+        """
+        current_task = self.get_tasks()[0]
+        site = Site.find_or_create(name, current_task=current_task.name)
+        return self._patch_site(site)
+
     def get_all_sites(self):
         sites = Site.find_all()
         return [self._patch_site(site) for site in sites]
@@ -122,22 +216,60 @@ class Treadmill:
 
 
 class Evaluator:
-    def __init__(self, site: Site, config: Dict[str, Any]):
+    def __init__(self, site: Site, config: Dict[str, Any], full: bool = True):
+        """Evaluator instance.
+
+        full: run all the checks of a task. When False, the checks are run
+              cheapest and most likely to fail first, and the remaining
+              checks are skipped once one fails.
+        """
         self.site = site
         self.config = config
+        self.full = full
 
-    def evaluate_task(self, task) -> TaskStatus:
+    def evaluate_task(self, task) -> Tuple[TaskStatus, List[Tuple[str, CheckStatus]], List[float]]:
         """Evaluate a single task for a site
+
+        Returns (task status, (validator, CheckStatus) of the checks that
+        were run, time taken by each of them). The runs are not recorded
+        here, as the result of a speculative evaluation may be discarded.
+        See stats.record_task_run.
         """
         print(f"[{self.site.base_url}] evaluating task {task.name}...")
 
-        results = [c.verify(self.site) for c in task.checks]
+        validators = [type(check).__name__ for check in task.checks]
+        titles = [str(check) for check in task.checks]
+        if self.full:
+            order = range(len(task.checks))
+        else:
+            order = stats.check_costs.order(titles)
+
+        results = [None] * len(task.checks)
+        runs = []  # (validator, CheckStatus) of the checks that were run
+        durations = []
+        failed = False
+        for i in order:
+            check = task.checks[i]
+            if failed and not self.full:
+                results[i] = CheckStatus(titles[i]).skip()
+                continue
+
+            start = time.perf_counter()
+            results[i] = check.verify(self.site)
+            duration = time.perf_counter() - start
+
+            passed = results[i].status == TaskStatus.PASS
+            stats.check_costs.observe(titles[i], duration, passed)
+            runs.append((validators[i], results[i]))
+            durations.append(duration)
+            failed = failed or not passed
         print(results)
+
         if all(c.status == TaskStatus.PASS for c in results):
             status = TaskStatus.PASS
         else:
             status = TaskStatus.FAIL
-        return TaskStatus(status, checks=results)
+        return TaskStatus(status, checks=results), runs, durations
 
 
 class check_not_implemented(Validator):
@@ -160,6 +292,8 @@ class check_webpage_content(Validator):
         return f"Check webpage content: {self.url}"
 
     def validate(self, site):
+        import requests
+
         base_url = site.base_url
         url = f"{base_url}{self.url}"
         if self.expected_text not in requests.get(url).text:
@@ -0,0 +1,103 @@
+"""Fingerprinted, precompressed static assets.
+
+On startup every file in the static directory is read, fingerprinted with
+a hash of its contents and compressed with gzip (and brotli, if it is
+installed). The files are served from memory under /assets with the hash
+in the name, so they can be cached forever by the browser.
+
+Templates refer to them using `asset_url`:
+
+    <link href="{{ asset_url('style.css') }}" rel="stylesheet" />
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from dataclasses import dataclass, field
+from typing import Dict
+
+from flask import Response, abort, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ["text/", "application/javascript", "application/json", "image/svg+xml"]
+
+
+@dataclass
+class Asset:
+    path: str
+    mimetype: str
+    etag: str
+    # encoding -> content, where encoding is "identity", "gzip" or "br"
+    contents: Dict[str, bytes] = field(default_factory=dict)
+
+
+class Assets:
+    def __init__(self, app, directory, url_prefix="/assets"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+
+        self.manifest: Dict[str, str] = {}  # path -> fingerprinted path
+        self.files: Dict[str, Asset] = {}  # fingerprinted path -> Asset
+        self.build()
+
+        app.add_url_rule(f"{url_prefix}/<path:filename>", "asset", self.serve)
+        app.add_template_global(self.url, "asset_url")
+
+    def build(self):
+        for root, dirs, files in os.walk(self.directory):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    self.add(path, f.read())
+
+    def add(self, path, content):
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        base, ext = os.path.splitext(path)
+        hashed_path = f"{base}.{digest}{ext}"
+
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        asset = Asset(path=hashed_path, mimetype=mimetype, etag=digest)
+        asset.contents["identity"] = content
+
+        if any(mimetype.startswith(t) for t in COMPRESSIBLE_TYPES):
+            compressed = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+            if brotli:
+                compressed["br"] = brotli.compress(content)
+            for encoding, data in compressed.items():
+                if len(data) < len(content):
+                    asset.contents[encoding] = data
+
+        self.manifest[path] = hashed_path
+        self.files[hashed_path] = asset
+
+    def url(self, path):
+        """Returns the URL of the fingerprinted version of a static file.
+        """
+        if path not in self.manifest:
+            return f"/static/{path}"
+        return f"{self.url_prefix}/{self.manifest[path]}"
+
+    def serve(self, filename):
+        asset = self.files.get(filename)
+        if not asset:
+            abort(404)
+
+        encoding = "identity"
+        for e in ["br", "gzip"]:
+            if e in asset.contents and e in request.accept_encodings:
+                encoding = e
+                break
+
+        response = Response(asset.contents[encoding], mimetype=asset.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        response.set_etag(f"{asset.etag}-{encoding}")
+        return response.make_conditional(request)
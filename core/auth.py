@@ -1,10 +1,15 @@
-import requests
 from flask import session
 
 from .db import User
 
 
 class Github:
+    # (connect, read) timeouts in seconds for all requests to github
+    timeout = (3.05, 10)
+
+    # connection pool shared by all instances, as one is created per request
+    _session = None
+
     def __init__(self, client_id, client_secret, redirect_uri):
         self.oauth_base_url = "https://github.com/login/oauth"
         self.api_base_url = "https://api.github.com"
@@ -13,16 +18,37 @@ class Github:
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
 
+    @classmethod
+    def get_session(cls):
+        """Returns the shared requests session, with retries and backoff.
+
+        Connection errors are retried for all requests. Read errors and
+        5xx responses are retried only for GET requests, as the code sent
+        to exchange for an access token can be used only once.
+        """
+        if cls._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+            )
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=20))
+            cls._session = session
+        return cls._session
+
     def get_oauth_url(self):
         return f"{self.oauth_base_url}/authorize?client_id={self.client_id}&redirect_uri={self.redirect_uri}"
 
     def get_access_token(self, code):
         """Get access token from github
         """
-        print("params: ", {"client_id": self.client_id,
-                            "client_secret": self.client_secret, "code": code})
         token_url = f"{self.oauth_base_url}/access_token"
-        r = requests.post(
+        r = self.get_session().post(
             token_url,
             headers={
                 "Accept": "application/json"
@@ -31,21 +57,22 @@ class Github:
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
                 "code": code,
-            })
+            },
+            timeout=self.timeout)
         r.raise_for_status()
-        print(r.json())
         return r.json()["access_token"]
 
     def get_username(self, token):
         """Get username from github
         """
         user_url = f"{self.api_base_url}/user"
-        r = requests.get(
+        r = self.get_session().get(
             user_url,
             headers={
                 "Accept": "application/json",
                 "Authorization": f"Bearer {token}",
-            })
+            },
+            timeout=self.timeout)
         r.raise_for_status()
         return r.json()["login"]
 
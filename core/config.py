@@ -6,7 +6,38 @@ _app_root = os.environ.get("APP_ROOT")
 db_path = f"{_app_root}/private/treadmill.db" if _app_root else "treadmill.db"
 db_uri = f"sqlite:///{db_path}"
 
+# days of check history kept in the check_run table
+check_run_retention_days = int(os.environ.get("CHECK_RUN_RETENTION_DAYS", 30))
+
+# directory for caches shared by all workers, like compiled templates.
+# Disabled when empty.
+cache_dir = os.environ.get("CACHE_DIR", f"{_app_root}/private/cache" if _app_root else "")
+
 github_client_id = os.environ.get("GITHUB_CLIENT_ID", "")
 github_client_secret = os.environ.get("GITHUB_CLIENT_SECRET", "")
 
+# github usernames of the instructors, who can see the progress of all sites
+instructors = [u for u in os.environ.get("INSTRUCTORS", "").split(",") if u]
+
+
+def _get_rate(name, default):
+    rate = float(os.environ.get(name, default))
+    if rate <= 0:
+        raise ValueError(f"{name} must be a positive number, got {rate}")
+    return rate
+
+
+# limits on refreshing a site, as (requests per minute, burst). The client
+# limit is per logged-in user.
+refresh_site_limit = (_get_rate("REFRESH_SITE_PER_MINUTE", 2), 3)
+refresh_client_limit = (_get_rate("REFRESH_CLIENT_PER_MINUTE", 10), 10)
+
+# profiling, enabled when PROFILE_DIR is set. See core/profiling.py.
+# Requests with the header "X-Profile: <PROFILE_TOKEN>" are always profiled.
+profile_dir = os.environ.get("PROFILE_DIR", "")
+profile_token = os.environ.get("PROFILE_TOKEN", "")
+profile_sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+profile_slow_ms = float(os.environ.get("PROFILE_SLOW_MS", 0))
+profile_max_files = int(os.environ.get("PROFILE_MAX_FILES", 100))
+
 secret_key = "development"
@@ -1,12 +1,42 @@
-import web
 import json
 import datetime
+import threading
+import time
+from types import MappingProxyType
 
 from . import config
 
 
+class LazyDB:
+    """Proxy to the web.py database, which is created on first use.
+
+    This keeps `import web` and the connection setup out of the import
+    time of the app, which matters for the CLI and for worker restarts.
+    """
+    def __init__(self, db_uri):
+        self.db_uri = db_uri
+        self._db = None
+
+    def __getattr__(self, name):
+        if self._db is None:
+            import web
+            self._db = web.database(self.db_uri)
+        return getattr(self._db, name)
+
+
 db_uri = config.db_uri
-db = web.database(db_uri)
+db = LazyDB(db_uri)
+
+
+def insert_or_ignore(table, key, values):
+    """Inserts a row, unless a row with the same value of the unique
+    column(s) `key` exists. Returns the number of rows inserted.
+    """
+    columns = ", ".join(values)
+    params = ", ".join(f"${column}" for column in values)
+    return db.query(f"INSERT INTO {table} ({columns}) VALUES ({params})"
+                    f" ON CONFLICT ({key}) DO NOTHING",
+                    vars=values)
 
 
 class Site:
@@ -21,19 +51,43 @@ class Site:
         # more data attributes, that are to be set externally
         self.base_url = None
 
+        # task name -> task status row, when read from the site cache
+        self._tasks = None
+
+    @classmethod
+    def from_state(cls, state):
+        site = cls.__new__(cls)
+        site.id = state.id
+        site.name = state.name
+        site.current_task = state.current_task
+        site.score = state.score
+        site.created = state.created
+        site.last_updated = state.last_updated
+        site.base_url = None
+        # read-only and shared with the cache; a write to the site drops
+        # it, see _touch
+        site._tasks = state.tasks
+        return site
+
     def parse_timestamp(self, timestamp):
         return datetime.datetime.fromisoformat(timestamp)
 
     @classmethod
     def find_all(cls):
-        rows = db.select("site", order="score desc")
-        return [cls(row) for row in rows]
+        return list(cls.iter_all())
+
+    @classmethod
+    def iter_all(cls, order="score desc"):
+        """Like find_all, but yields the sites one by one from the cursor.
+        """
+        for row in db.select("site", order=order):
+            yield cls(row)
 
     @classmethod
     def find(cls, name):
-        row = db.where("site", name=name).first()
-        if row:
-            return cls(row)
+        state = site_cache.get(name)
+        if state:
+            return cls.from_state(state)
 
     @classmethod
     def create(cls, name, **kwargs):
@@ -41,22 +95,52 @@ class Site:
         row = db.select("site", where="id=$id", vars={"id": id}).first()
         return cls(row)
 
+    @classmethod
+    def find_or_create(cls, name, **kwargs):
+        """Finds the site with the given name, creating it if it doesn't exist.
+        """
+        # insert first, doing nothing if the site exists, so that there is
+        # no race between finding and creating it in concurrent requests
+        insert_or_ignore("site", "name", dict(kwargs, name=name, score=0))
+        return cls.find(name)
+
     def set_userdata(self, key, value):
-        if self.get_userdata(key):
-            db.update("site_userdata",
-                      value=value,
-                      where="site_id=$self.id and key=$key",
-                      vars=locals())
-        else:
-            db.insert("site_userdata",
-                      site_id=self.id,
-                      key=key,
-                      value=value)
+        self.set_userdata_many({key: value})
 
     def get_userdata(self, key):
         row = db.where("site_userdata", site_id=self.id, key=key).first()
         return row and row.value
 
+    def set_userdata_many(self, data):
+        """Sets multiple userdata values with a single upsert.
+        """
+        if not data:
+            return
+
+        vars = {"site_id": self.id}
+        rows = []
+        for i, (key, value) in enumerate(data.items()):
+            vars[f"key{i}"] = key
+            vars[f"value{i}"] = value
+            rows.append(f"($site_id, $key{i}, $value{i})")
+
+        db.query("INSERT INTO site_userdata (site_id, key, value)"
+                 f" VALUES {', '.join(rows)}"
+                 " ON CONFLICT (site_id, key) DO UPDATE SET value = excluded.value",
+                 vars=vars)
+
+    def get_userdata_many(self, keys):
+        """Returns a dict with the values of the given keys that are set.
+        """
+        if not keys:
+            return {}
+
+        rows = db.select("site_userdata",
+                         what="key, value",
+                         where="site_id=$site_id and key in $keys",
+                         vars={"site_id": self.id, "keys": list(keys)})
+        return {row.key: row.value for row in rows}
+
     def is_task_done(self, task_name):
         rows = db.where("task", site_id=self.id, name=task_name)
         return bool(rows)
@@ -77,35 +161,100 @@ class Site:
         db.insert("changelog", site_id=self.id, type=type, message=message)
 
     def _update(self, **kwargs):
+        self._update_row(**kwargs)
+        self._touch()
+
+    def _update_row(self, **kwargs):
         db.update("site", **kwargs, where="id=$id", vars={"id": self.id})
 
+    def _touch(self):
+        """Marks cached copies of the site in all processes as stale.
+        Must be called after writing to the site or its tasks.
+        """
+        self._tasks = None
+        db.query(
+            "INSERT INTO site_generation (site_id, generation) VALUES ($site_id, 1)"
+            " ON CONFLICT (site_id) DO UPDATE SET generation = generation + 1",
+            vars={"site_id": self.id})
+        site_cache.invalidate(self.name)
+
     def update_score(self):
+        self._update(score=self._get_score())
+
+    def _get_score(self):
         rows = db.where("task", site_id=self.id).list()
-        score = len(rows)
-        self._update(score=score)
+        return len(rows)
 
     def update_status(self, status):
-        self.add_changelog("deploy", "Deployed the site")
-        self._update(current_task=status['current_task'])
+        """Saves the status returned by Treadmill.get_status.
+
+        The site and its tasks are written in one transaction, which
+        marks cached copies of the site as stale once.
+        """
+        changed = self.is_status_changed(status)
+        with db.transaction():
+            if changed:
+                self.add_changelog("deploy", "Deployed the site")
 
-        for task_name, task_status in status['tasks'].items():
-            self.update_task_status(task_name, task_status)
+            for task_name, task_status in status['tasks'].items():
+                self._save_task_status(task_name, task_status)
 
-        self.update_score()
+            self._update_row(current_task=status['current_task'], score=self._get_score())
+            self._touch()
+        invalidate_progress_matrix()
+
+    def is_status_changed(self, status):
+        """Returns True if the current task or the status of any task in
+        status differs from the last saved status.
+        """
+        previous = self.get_status()
+        if previous["current_task"] != status["current_task"]:
+            return True
+        return any(previous["tasks"].get(name, {}).get("status") != task_status["status"]
+                   for name, task_status in status["tasks"].items())
 
     def has_task(self, name):
         return db.where("task", site_id=self.id, name=name).first() is not None
 
     def get_task_status(self, name):
+        if self._tasks is not None:
+            return self._tasks.get(name)
+
         task_status = db.where("task", site_id=self.id, name=name).first()
         if task_status:
             task_status.checks = json.loads(task_status.checks)
         return task_status
 
+    def get_task_statuses(self):
+        """Returns a dict of task name -> task status row, of all tasks.
+
+        When the site was read from the site cache, the dict and the rows
+        are shared with it and are read-only.
+        """
+        if self._tasks is None:
+            self._tasks = _load_task_statuses(self.id)
+        return self._tasks
+
+    def get_status(self):
+        """Returns the last saved status of the site, in the same format
+        as Treadmill.get_status.
+        """
+        tasks = {name: {"status": row.status, "checks": row.checks}
+                 for name, row in self.get_task_statuses().items()}
+        return dict(tasks=tasks, current_task=self.current_task)
+
     def update_task_status(self, name, task_status):
+        self._save_task_status(name, task_status)
+        self._touch()
+
+    def _save_task_status(self, name, task_status):
         status = task_status['status']
         checks = json.dumps(task_status['checks'])
-        if self.has_task(name):
+        previous = db.where("task", site_id=self.id, name=name).first()
+        if status == "pass" and (not previous or previous.status != "pass"):
+            self._record_completion(name)
+
+        if previous:
             db.update("task",
                 status=status,
                 checks=checks,
@@ -118,6 +267,298 @@ class Site:
                 status=status,
                 checks=checks)
 
+    def _record_completion(self, task_name):
+        """Records the time taken to complete the task, the first time
+        it passes.
+        """
+        from . import stats
+
+        if not insert_or_ignore("task_completion", "site_id, task",
+                                {"site_id": self.id, "task": task_name}):
+            # completed before, and passing again after a regression
+            return
+        now = datetime.datetime.utcnow()
+        stats.record(stats.COMPLETION, task_name, (now - self.created).total_seconds())
+
+
+def _load_task_statuses(site_id):
+    rows = db.where("task", site_id=site_id)
+    tasks = {}
+    for row in rows:
+        row.checks = json.loads(row.checks)
+        tasks[row.name] = row
+    return tasks
+
+
+class ReadOnlyRow(dict):
+    """Row with attribute access, like web.Storage, that can't be modified.
+    Used for rows that are shared between requests.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError as e:
+            raise AttributeError(key) from e
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("read-only row")
+
+    __setattr__ = __delattr__ = __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+def _freeze_task_status(row):
+    checks = tuple(ReadOnlyRow(check) for check in row.checks)
+    return ReadOnlyRow(row, checks=checks)
+
+
+class SiteState:
+    """Cached state of a site and its tasks, as read from the database.
+
+    The task statuses are read-only, as they are shared by all the Site
+    objects created from the state.
+    """
+    __slots__ = ("id", "name", "current_task", "score", "created", "last_updated",
+                 "generation", "tasks")
+
+    def __init__(self, row, tasks):
+        self.id = row.id
+        self.name = row.name
+        self.current_task = row.current_task
+        self.score = row.score
+        self.created = datetime.datetime.fromisoformat(row.created)
+        self.last_updated = datetime.datetime.fromisoformat(row.last_updated)
+        self.generation = row.generation
+        self.tasks = MappingProxyType(
+            {name: _freeze_task_status(row) for name, row in tasks.items()})
+
+
+class SiteCache:
+    """Read-through cache of SiteState by site name.
+
+    A cached state is used only if the generation of the site in the
+    database is still the one it was read with. Writes increment the
+    generation (see Site._touch), so a write in any process invalidates
+    the copies cached by all of them, and a hit costs one lookup by
+    primary key instead of reading the site and all its tasks.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        state = self._states.get(name)
+        if state and self._get_generation(state.id) == state.generation:
+            return state
+
+        state = self._load(name)
+        with self._lock:
+            if state is None:
+                self._states.pop(name, None)
+                return None
+            if len(self._states) >= self.max_size:
+                self._states.clear()
+            self._states[name] = state
+        return state
+
+    def invalidate(self, name):
+        with self._lock:
+            self._states.pop(name, None)
+
+    def _get_generation(self, site_id):
+        row = db.select("site_generation", what="generation",
+                        where="site_id=$site_id", vars={"site_id": site_id}).first()
+        return row.generation if row else 0
+
+    def _load(self, name):
+        # The site and its generation are read in one statement, and the
+        # tasks after it; the reads are not in one snapshot. A write in
+        # between leaves the state with a generation older than its tasks,
+        # which fails validation on the next get and is reloaded, so a
+        # stale state is never kept.
+        row = db.query(
+            "SELECT site.*, coalesce(site_generation.generation, 0) AS generation"
+            " FROM site LEFT JOIN site_generation ON site_generation.site_id = site.id"
+            " WHERE site.name = $name",
+            vars={"name": name}).first()
+        if not row:
+            return None
+        return SiteState(row, _load_task_statuses(row.id))
+
+
+site_cache = SiteCache()
+
+
+class SiteProgress:
+    def __init__(self, row):
+        self.name = row.name
+        self.current_task = row.current_task
+        self.score = row.score
+
+        # task name -> status, for the tasks that have been evaluated
+        self.tasks = {}
+        for item in (row.tasks or "").split("\x1e"):
+            if item:
+                name, status = item.split("\x1f")
+                self.tasks[name] = status
+
+    def get_task_status(self, name):
+        """Returns the last saved status of a task, "pass" or "fail", or
+        "locked" if it hasn't been evaluated.
+        """
+        return self.tasks.get(name, "locked")
+
+    def is_current(self, task):
+        """Returns True if the site is working on the task: it is the
+        current task, or it hasn't passed and all its dependencies have.
+        """
+        if task.name == self.current_task:
+            return True
+        return (self.tasks.get(task.name) != "pass"
+                and all(self.tasks.get(name) == "pass" for name in task.depends_on))
+
+    def has_status(self, task, status):
+        """Returns True if the task is in status, which is one of "pass",
+        "fail", "locked" or "current".
+        """
+        if status == "current":
+            return self.is_current(task)
+        return self.get_task_status(task.name) == status
+
+
+# cached result of get_progress_matrix, as (version, list of SiteProgress)
+_progress_matrix = None
+
+
+def _get_progress_version():
+    """Returns a value that changes whenever a site is created or any site
+    is written to, in any process. See Site._touch.
+    """
+    row = db.query(
+        "SELECT (SELECT count(*) FROM site) AS sites,"
+        " (SELECT coalesce(sum(generation), 0) FROM site_generation) AS generation").first()
+    return (row.sites, row.generation)
+
+
+def get_progress_matrix():
+    """Returns the progress of all sites, ordered by name.
+
+    The statuses of all tasks of all sites are read in one query. The
+    result is reused until a site is created or updated.
+    """
+    global _progress_matrix
+    version = _get_progress_version()
+    if _progress_matrix and _progress_matrix[0] == version:
+        return _progress_matrix[1]
+
+    rows = db.query(
+        "SELECT site.name, site.current_task, site.score,"
+        " group_concat(task.name || char(31) || task.status, char(30)) AS tasks"
+        " FROM site LEFT JOIN task ON task.site_id = site.id"
+        " GROUP BY site.id"
+        " ORDER BY site.name")
+    matrix = [SiteProgress(row) for row in rows]
+    _progress_matrix = (version, matrix)
+    return matrix
+
+
+def invalidate_progress_matrix():
+    global _progress_matrix
+    _progress_matrix = None
+
+
+def iter_task_statuses(page_size=500):
+    """Yields the status of every task of every site, one row at a time.
+
+    Sites without any evaluated task are included once, with task and
+    status set to None.
+
+    The rows are read in pages by key, and each page is read completely
+    before it is yielded, so that no query stays open while the caller
+    is slow to consume the rows, as an open read blocks all writers.
+    """
+    last = ("", -1)
+    while True:
+        rows = db.query(
+            "SELECT site.name AS site, site.current_task, site.score,"
+            " task.name AS task, task.status, task.timestamp,"
+            " coalesce(task.id, 0) AS task_id"
+            " FROM site LEFT JOIN task ON task.site_id = site.id"
+            " WHERE (site.name, coalesce(task.id, 0)) > ($site, $task_id)"
+            " ORDER BY site.name, task_id"
+            " LIMIT $limit",
+            vars={"site": last[0], "task_id": last[1], "limit": page_size}).list()
+        yield from rows
+        if len(rows) < page_size:
+            break
+        last = (rows[-1].site, rows[-1].task_id)
+
+
+class SiteLease:
+    """Lease of a site by an evaluator worker.
+    """
+    @classmethod
+    def find_due(cls, shard, shards, interval, limit=10):
+        """Returns names of sites in the shard that aren't leased and
+        haven't been evaluated in the last `interval` seconds, the least
+        recently evaluated first.
+        """
+        now = time.time()
+        rows = db.query(
+            "SELECT site.name FROM site"
+            " LEFT JOIN site_lease ON site_lease.site_id = site.id"
+            " WHERE site.id % $shards = $shard"
+            " AND coalesce(site_lease.expires, 0) < $now"
+            " AND coalesce(site_lease.last_evaluated, 0) < $due"
+            " ORDER BY coalesce(site_lease.last_evaluated, 0)"
+            " LIMIT $limit",
+            vars={"shard": shard, "shards": shards, "now": now,
+                  "due": now - interval, "limit": limit})
+        return [row.name for row in rows]
+
+    @classmethod
+    def claim(cls, site, worker, duration):
+        """Claims the site for the worker for `duration` seconds.
+
+        Returns True if the lease was acquired, False if the site is
+        leased by another worker.
+        """
+        now = time.time()
+        db.query(
+            "INSERT INTO site_lease (site_id, worker, expires)"
+            " VALUES ($site_id, $worker, $expires)"
+            " ON CONFLICT (site_id) DO UPDATE SET"
+            " worker = excluded.worker,"
+            " expires = excluded.expires"
+            " WHERE site_lease.expires < $now",
+            vars={"site_id": site.id, "worker": worker,
+                  "expires": now + duration, "now": now})
+        row = db.where("site_lease", site_id=site.id).first()
+        return row.worker == worker and row.expires > now
+
+    @classmethod
+    def mark_evaluated(cls, site):
+        """Marks the site as evaluated now, when it was evaluated outside
+        of the workers, so that they don't evaluate it again too soon.
+        """
+        db.query(
+            "INSERT INTO site_lease (site_id, last_evaluated) VALUES ($site_id, $now)"
+            " ON CONFLICT (site_id) DO UPDATE SET last_evaluated = excluded.last_evaluated",
+            vars={"site_id": site.id, "now": time.time()})
+
+    @classmethod
+    def release(cls, site, worker):
+        """Releases the lease, marking the site as evaluated now.
+        """
+        db.update("site_lease",
+                  expires=0,
+                  last_evaluated=time.time(),
+                  where="site_id=$site_id and worker=$worker",
+                  vars={"site_id": site.id, "worker": worker})
+
 
 class User:
     def __init__(self, row):
@@ -126,8 +567,14 @@ class User:
 
     @classmethod
     def find_all(cls):
-        rows = db.select("user")
-        return [cls(row) for row in rows]
+        return list(cls.iter_all())
+
+    @classmethod
+    def iter_all(cls):
+        """Like find_all, but yields the users one by one from the cursor.
+        """
+        for row in db.select("user"):
+            yield cls(row)
 
     @classmethod
     def find(cls, **kwargs):
@@ -140,3 +587,10 @@ class User:
         id = db.insert("user", **kwargs)
         row = db.select("user", where="id=$id", vars={"id": id}).first()
         return cls(row)
+
+    @classmethod
+    def find_or_create(cls, **kwargs):
+        """Finds the user with the given username, creating it if it doesn't exist.
+        """
+        insert_or_ignore("user", "username", kwargs)
+        return cls.find(**kwargs)
@@ -0,0 +1,232 @@
+"""DNS records of the base domain.
+
+`DNSSync` keeps an index of the records in the zone, keyed by name, and
+applies changes in batches from a background thread so that they are not
+made in the request that triggered them. The DNS service itself is behind
+a `DNSProvider`; `InMemoryProvider` can be used in place of a real one
+for testing.
+"""
+from __future__ import annotations
+
+import atexit
+import itertools
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+
+@dataclass
+class DNSRecord:
+    name: str
+    data: str
+    type: str = "A"
+    ttl: int = 120  # 2 mins, for easy debugging
+    id: Optional[int] = None
+
+
+class DNSProvider:
+    """Base class for DNS providers.
+    """
+    def list_records(self) -> List[DNSRecord]:
+        raise NotImplementedError()
+
+    def create_record(self, record: DNSRecord) -> DNSRecord:
+        """Creates a record and returns it with its id set.
+        """
+        raise NotImplementedError()
+
+    def update_record(self, record: DNSRecord):
+        raise NotImplementedError()
+
+
+class InMemoryProvider(DNSProvider):
+    def __init__(self, records: Optional[List[DNSRecord]] = None):
+        self._ids = itertools.count(1)
+        self.records: Dict[int, DNSRecord] = {}
+        for record in records or []:
+            self.create_record(record)
+
+    def list_records(self):
+        return [replace(r) for r in self.records.values()]
+
+    def create_record(self, record):
+        record = replace(record)
+        record.id = next(self._ids)
+        self.records[record.id] = record
+        return replace(record)
+
+    def update_record(self, record):
+        if record.id not in self.records:
+            raise KeyError(f"Unknown record: {record.id}")
+        self.records[record.id] = replace(record)
+
+
+class DigitalOceanProvider(DNSProvider):
+    def __init__(self, token, domain_name):
+        self.token = token
+        self.domain_name = domain_name
+        self._do_records = {}  # id -> digitalocean.Record, from the last listing
+
+    def _get_domain(self):
+        import digitalocean
+        return digitalocean.Domain(token=self.token, name=self.domain_name)
+
+    def list_records(self):
+        do_records = self._get_domain().get_records()
+        self._do_records = {r.id: r for r in do_records}
+        return [DNSRecord(name=r.name, data=r.data, type=r.type, ttl=r.ttl, id=r.id)
+                for r in do_records]
+
+    def create_record(self, record):
+        d = self._get_domain().create_new_domain_record(
+            type=record.type,
+            name=record.name,
+            data=record.data,
+            ttl=str(record.ttl),
+        )
+        return replace(record, id=d["domain_record"]["id"])
+
+    def update_record(self, record):
+        import digitalocean
+
+        do_record = self._do_records.get(record.id) or digitalocean.Record.get_object(
+            api_token=self.token, domain=self.domain_name, record_id=record.id)
+        do_record.data = record.data
+        do_record.save()
+
+
+class DNSSync:
+    """Cached index of the DNS records of a zone, with batched updates.
+
+    Changes are queued with `set_record` and applied by `flush`, which
+    runs in a background thread `batch_delay` seconds after the first
+    queued change. The index is reloaded at most once per flush, when a
+    change would otherwise be skipped or create a new record, so a batch
+    of changes costs at most one listing of the zone.
+
+    A change that fails stays queued and is retried with exponential
+    backoff, up to `max_retry_delay` seconds apart, unless a newer value
+    has been queued for the same name. Changes still pending at exit are
+    flushed at exit.
+    """
+    def __init__(self, provider: DNSProvider, batch_delay: float = 1.0, max_age: float = 300,
+                 max_retry_delay: float = 300):
+        self.provider = provider
+        self.batch_delay = batch_delay
+        self.max_age = max_age
+        self.max_retry_delay = max_retry_delay
+
+        self._index: Optional[Dict[str, DNSRecord]] = None
+        self._index_loaded_at = 0.0
+        self._flush_started_at = 0.0
+        self._index_stale = False  # set after a failed change
+        self._pending: Dict[str, DNSRecord] = {}
+        self._attempts: Dict[str, int] = {}  # name -> number of failed attempts
+        self._retry_at: Dict[str, float] = {}  # name -> time of the next attempt
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _get_index(self) -> Dict[str, DNSRecord]:
+        if self._index is None or time.monotonic() - self._index_loaded_at > self.max_age:
+            self._load_index()
+        return self._index
+
+    def _load_index(self):
+        records = self.provider.list_records()
+        self._index = {r.name: r for r in records if r.type == "A"}
+        self._index_loaded_at = time.monotonic()
+
+    def get_record(self, name) -> Optional[DNSRecord]:
+        """Returns the A record with the given name, if it exists.
+        """
+        return self._get_index().get(name)
+
+    def set_record(self, name, data, ttl=120):
+        """Queues creating or updating the A record of name to point to data.
+        """
+        with self._lock:
+            self._pending[name] = DNSRecord(name=name, data=data, ttl=ttl)
+        self._start()
+        self._wakeup.set()
+
+    def flush(self, force=False):
+        """Applies the pending changes that are due.
+
+        force: apply all pending changes, even those waiting to be retried
+        """
+        with self._flush_lock:
+            now = time.monotonic()
+            self._flush_started_at = now
+            if self._index_stale:
+                self._index = None
+                self._index_stale = False
+            with self._lock:
+                due = {name: record for name, record in self._pending.items()
+                       if force or self._retry_at.get(name, 0) <= now}
+                for name in due:
+                    del self._pending[name]
+
+            for record in due.values():
+                try:
+                    self._apply(record)
+                except Exception as e:
+                    # the index may be out of date; reload it next flush
+                    self._index_stale = True
+                    self._retry(record, e)
+                else:
+                    with self._lock:
+                        self._attempts.pop(record.name, None)
+                        self._retry_at.pop(record.name, None)
+
+    def _retry(self, record, error):
+        with self._lock:
+            attempts = self._attempts.get(record.name, 0) + 1
+            delay = min(self.max_retry_delay, self.batch_delay * 2 ** attempts)
+            self._attempts[record.name] = attempts
+            self._retry_at[record.name] = time.monotonic() + delay
+            # keep a newer value, if one was queued while this one was applied
+            self._pending.setdefault(record.name, record)
+
+        print(f"[dns] failed to set {record.name} -> {record.data}"
+              f" (attempt {attempts}), retrying in {delay:.0f}s: {error}")
+
+    def _apply(self, record):
+        existing = self.get_record(record.name)
+        if ((existing is None or existing.data == record.data)
+                and self._index_loaded_at < self._flush_started_at):
+            # the index may be out of date, as the record may have been
+            # created or changed by another process since it was loaded.
+            # Reloaded at most once per flush.
+            self._load_index()
+            existing = self.get_record(record.name)
+
+        if existing is None:
+            print(f"[dns] creating {record.name} -> {record.data}")
+            self._get_index()[record.name] = self.provider.create_record(record)
+        elif existing.data != record.data:
+            print(f"[dns] updating {record.name} -> {record.data}")
+            updated = replace(existing, data=record.data)
+            self.provider.update_record(updated)
+            self._get_index()[record.name] = updated
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="dns-sync", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush, force=True)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                retry_at = min(self._retry_at.values(), default=None)
+            timeout = None if retry_at is None else max(0, retry_at - time.monotonic())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            # give other changes a chance to be batched with this one
+            time.sleep(self.batch_delay)
+            self.flush()
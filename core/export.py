@@ -0,0 +1,50 @@
+"""Streaming export of the progress of all sites.
+
+The exporters take an iterable of rows, like the one returned by
+`db.iter_task_statuses`, and yield the output in chunks of text, so that
+the whole export is never held in memory.
+"""
+import csv
+import io
+import json
+
+
+FIELDS = ["site", "current_task", "score", "task", "status", "timestamp"]
+
+# number of rows written per chunk
+CHUNK_SIZE = 500
+
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([row[f] for f in FIELDS])
+        if i % CHUNK_SIZE == 0:
+            yield _flush(buffer)
+    yield _flush(buffer)
+
+
+def export_ndjson(rows):
+    buffer = io.StringIO()
+    for i, row in enumerate(rows, 1):
+        buffer.write(json.dumps({f: row[f] for f in FIELDS}))
+        buffer.write("\n")
+        if i % CHUNK_SIZE == 0:
+            yield _flush(buffer)
+    yield _flush(buffer)
+
+
+def _flush(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+# format -> (exporter, mimetype)
+EXPORTERS = {
+    "csv": (export_csv, "text/csv"),
+    "ndjson": (export_ndjson, "application/x-ndjson"),
+}
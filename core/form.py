@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import functools
 import html
 import re
 from dataclasses import dataclass, field
@@ -106,13 +107,19 @@ class Form:
     description: str
     inputs: List[InputSpec]
 
+    def __post_init__(self):
+        # validators of each input, bound once when the form is loaded.
+        # Not a dataclass field, so that asdict() doesn't copy it.
+        self._bound_validators = [
+            (str(input_spec["name"]), input_spec, get_input_type(str(input_spec["type"])).validators)
+            for input_spec in self.inputs
+        ]
+
     def validate(self, values: UserInput):
-        for input_spec in self.inputs:
-            input_name, type_name = str(input_spec["name"]), str(input_spec["type"])
-            input_type = _input_types[type_name]
+        for input_name, input_spec, validators in self._bound_validators:
             value = values[input_name]
 
-            for validator in input_type.validators:
+            for validator in validators:
                 validator(input_spec, value)
 
     def _get_userdata_key(self, input_name: str):
@@ -121,25 +128,21 @@ class Form:
     def save(self, site: Site, data: UserInput):
         """Called when form is submitted
         """
-        # NOTE: should we save all values as a single JSON userdata?
-        # That is an implementation detail and can be changed
-        # later on after some more thought.
+        values = {}
         for input_spec in self.inputs:
             input_name = str(input_spec["name"])
             if input_name in data:
                 db_key = self._get_userdata_key(input_name)
-                site.set_userdata(db_key, str(data[input_name]))
+                values[db_key] = str(data[input_name])
+        site.set_userdata_many(values)
 
     def get_current_values(self, site: Site):
         """Get current values from the database
         """
-        values = {}
-        for input_spec in self.inputs:
-            input_name = str(input_spec["name"])
-            db_key = self._get_userdata_key(input_name)
-            if (value := site.get_userdata(db_key)):
-                values[input_name] = value
-        return values
+        keys = {self._get_userdata_key(str(input_spec["name"])): str(input_spec["name"])
+                for input_spec in self.inputs}
+        rows = site.get_userdata_many(list(keys))
+        return {keys[db_key]: value for db_key, value in rows.items() if value}
 
 
 def create_form(name: str, conf: Dict) -> Form:
@@ -162,9 +165,16 @@ def create_form(name: str, conf: Dict) -> Form:
     inputs = conf["inputs"]
 
     # TODO: maybe validate conf-dict with something like pydantic?
-    # TODO: validate for each input that its type is registered
 
-    return Form(name=name, description=description, inputs=inputs)
+    # Form raises ValueError if the type of any input is not registered
+    form = Form(name=name, description=description, inputs=inputs)
+
+    for input_spec in inputs:
+        if (regex := input_spec.get("regex")):
+            compile_regex(str(regex))
+        _get_html_skeleton(input_spec)
+
+    return form
 
 
 def get_input_type(type_name: str) -> InputType:
@@ -173,10 +183,29 @@ def get_input_type(type_name: str) -> InputType:
     return _input_types[type_name]
 
 
+# Templaters are rendered once per input spec with this placeholder as the
+# value, and only the escaped value is filled in on each request.
+_VALUE_PLACEHOLDER = "\x00value\x00"
+_html_skeletons: Dict[str, List[str]] = {}
+
+
+def _get_html_skeleton(input_spec: InputSpec) -> List[str]:
+    key = repr(sorted(input_spec.items()))
+    if key not in _html_skeletons:
+        type_name = str(input_spec["type"])
+        input_type = get_input_type(type_name)
+        input_html = input_type.templater(input_type, input_spec, _VALUE_PLACEHOLDER)
+        _html_skeletons[key] = input_html.split(_VALUE_PLACEHOLDER)
+    return _html_skeletons[key]
+
+
 def make_input_html(input_spec: InputSpec, default_value: str) -> str:
-    type_name = str(input_spec["type"])
-    input_type = get_input_type(type_name)
-    return input_type.templater(input_type, input_spec, default_value)
+    return html.escape(default_value).join(_get_html_skeleton(input_spec))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_regex(regex: str) -> re.Pattern:
+    return re.compile(regex)
 
 
 register_input_type("string", html_type="text", templater=default_templater)
@@ -190,7 +219,7 @@ def regex_validator(input_spec: InputSpec, value: str):
     if not regex:
         return
 
-    if not re.match(str(regex), value):
+    if not compile_regex(str(regex)).match(value):
         raise ValidationError(f"Value does not match regex: {regex}")
 
 
@@ -214,8 +243,10 @@ def max_value_validator(input_spec: InputSpec, value: int):
         raise ValidationError(f"Value must be at most {max_value}")
 
 
+_ipv4_regex = re.compile(r"^((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)\.?\b){4}$")
+
+
 @register_validator(input_type="ipaddr")
 def validate_ipv4(input_spec: InputSpec, value: str):
-    ipv4_regex = re.compile(r"^((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)\.?\b){4}$")
-    if not ipv4_regex.match(value):
+    if not _ipv4_regex.match(value):
         raise ValidationError("Value is not a valid IPv4 address")
@@ -0,0 +1,133 @@
+"""On-demand profiling with cProfile.
+
+A profiled run is saved as a pstats file in the profile directory when it
+was asked for explicitly, when it was picked by sampling, or when it took
+longer than the slow threshold. Only the newest `max_files` files are
+kept. Read them with:
+
+    python -m pstats <file>
+
+cProfile only sees the thread that started it, so the checks that
+Treadmill.get_status runs in its thread pool don't appear in the profile
+of a request, only the time spent waiting for them.
+"""
+import cProfile
+import datetime
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from . import config
+
+
+@dataclass
+class ProfileSession:
+    profile: cProfile.Profile
+    start: float
+    save: bool  # saved irrespective of the time taken
+
+
+class Profiler:
+    def __init__(self, directory, max_files=100, sample_rate=0.0, slow_ms=0.0):
+        """Profiler instance.
+
+        directory: where to write pstats files. Profiling is disabled if empty.
+        max_files: number of newest files to keep
+        sample_rate: fraction of runs to profile
+        slow_ms: when non-zero, every run is profiled and saved if it takes
+                 longer than this
+        """
+        self.directory = directory
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def start(self, force=False) -> Optional[ProfileSession]:
+        """Starts profiling if this run is to be profiled.
+
+        force: profile and save this run, e.g. when asked for in a request
+        """
+        if not self.enabled:
+            return None
+
+        save = force or random.random() < self.sample_rate
+        if not save and not self.slow_ms:
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already active
+            return None
+        return ProfileSession(profile=profile, start=time.perf_counter(), save=save)
+
+    def stop(self, session: ProfileSession, name: str):
+        """Stops profiling and saves the profile if required.
+        """
+        session.profile.disable()
+        elapsed_ms = (time.perf_counter() - session.start) * 1000
+
+        if session.save or (self.slow_ms and elapsed_ms > self.slow_ms):
+            self.save(session.profile, name, elapsed_ms)
+
+    @contextmanager
+    def profile(self, name, force=False):
+        session = self.start(force)
+        try:
+            yield
+        finally:
+            if session:
+                self.stop(session, name)
+
+    def save(self, profile, name, elapsed_ms):
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        filename = f"{timestamp}-{os.getpid()}-{name}-{elapsed_ms:.0f}ms.pstats"
+        path = os.path.join(self.directory, filename)
+        profile.dump_stats(path)
+        print(f"[profile] saved {path}")
+
+        self.rotate()
+
+    def rotate(self):
+        """Deletes the oldest profiles, keeping only max_files of them.
+        """
+        paths = [os.path.join(self.directory, f)
+                 for f in os.listdir(self.directory) if f.endswith(".pstats")]
+        paths.sort(key=_get_mtime)
+        for path in paths[:-self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by another worker
+                pass
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        # removed by another worker; it is skipped when removing
+        return 0
+
+
+def get_profiler():
+    """Returns a Profiler configured from core.config.
+    """
+    return Profiler(
+        directory=config.profile_dir,
+        max_files=config.profile_max_files,
+        sample_rate=config.profile_sample_rate,
+        slow_ms=config.profile_slow_ms,
+    )
@@ -0,0 +1,107 @@
+"""Admission control for expensive requests.
+
+`RateLimiter` keeps a token bucket per key (like a site name or a client
+address) and `Coalescer` lets concurrent callers for the same key share
+the result of one call. Both are in-process, so the limits apply to each
+worker separately.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up
+    to `capacity` events.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def consume(self, now=None):
+        """Takes a token, if available. Returns True if it was taken.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def get_wait_time(self):
+        """Returns seconds until the next token is available.
+        """
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Token buckets keyed by name.
+
+    Only the `max_keys` most recently used buckets are kept. A bucket
+    that is dropped is full anyway if it hasn't been used for
+    capacity/rate seconds.
+    """
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Returns True if the request for key is allowed.
+        """
+        return self.check(key)[0]
+
+    def check(self, key):
+        """Returns (allowed, seconds to wait before the next request).
+        """
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or TokenBucket(self.rate, self.capacity)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+            allowed = bucket.consume()
+            return allowed, bucket.get_wait_time()
+
+
+class Coalescer:
+    """Runs one call per key at a time, sharing its result with all the
+    callers that ask for the same key while it is running.
+    """
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def get_running(self, key):
+        """Returns a Future for the result of the call running for key,
+        or None if there isn't one.
+        """
+        with self._lock:
+            return self._futures.get(key)
+
+    def run(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._futures[key]
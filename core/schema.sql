@@ -15,6 +15,8 @@ create table site_userdata (
     value text
 );
 
+create unique index site_userdata_site_key on site_userdata (site_id, key);
+
 create table task (
     id integer primary key,
     site_id integer references site(id),
@@ -43,3 +45,66 @@ create table user (
     id integer primary key,
     username text unique not null
 );
+
+-- check_run keeps the history of every check run by the evaluator
+create table check_run (
+    id integer primary key,
+    site_id integer references site(id),
+    task text,
+    validator text,
+    status text, -- pass, fail, error
+    duration real, -- seconds
+    timestamp text default CURRENT_TIMESTAMP
+);
+
+-- for pruning old history
+create index check_run_timestamp on check_run (timestamp);
+
+-- rolling aggregates, updated incrementally on every run
+-- kind is one of:
+--   validator  - latency of a check, name is the validator class
+--   check      - latency of a check, name is its title (str(check))
+--   task       - latency of evaluating a task, name is the task
+--   completion - time from site creation to completing a task
+create table stats (
+    kind text,
+    name text,
+    count int default 0,
+    passed int default 0,
+    total real default 0,
+    primary key (kind, name)
+);
+
+-- first completion of each task by each site, so that time-to-complete
+-- is recorded once even if the task fails and passes again later
+create table task_completion (
+    site_id integer references site(id),
+    task text,
+    timestamp text default CURRENT_TIMESTAMP,
+    primary key (site_id, task)
+);
+
+-- log-scale histogram of the values in stats, for percentiles
+create table stats_histogram (
+    kind text,
+    name text,
+    bucket int,
+    count int default 0,
+    primary key (kind, name, bucket)
+);
+
+-- sites claimed by evaluator workers. A lease is held until expires
+-- (unix time), so that the site is picked up again if a worker crashes.
+create table site_lease (
+    site_id integer primary key references site(id),
+    worker text,
+    expires real default 0,
+    last_evaluated real -- unix time
+);
+
+-- generation of each site, incremented on every write to the site or
+-- its tasks, so that cached reads of a site can be validated cheaply
+create table site_generation (
+    site_id integer primary key references site(id),
+    generation int default 0
+);
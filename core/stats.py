@@ -0,0 +1,194 @@
+"""Aggregate statistics of check runs.
+
+The counters are kept in the `stats` table and a log-scale histogram of
+the values in `stats_histogram`, so that every run is a couple of
+atomic upserts and percentiles can be read without scanning the history.
+
+`CheckCosts` keeps in-process moving averages of the latency and failure
+rate of each check, used to decide the order of checks. They start from
+the aggregates of the check in the `stats` table, so that the order
+survives restarts.
+"""
+import math
+import threading
+from itertools import groupby
+
+from . import config
+from .db import db
+
+
+VALIDATOR = "validator"
+CHECK = "check"
+TASK = "task"
+COMPLETION = "completion"
+
+# number of histogram buckets per power of 10. Each bucket is ~26% wide.
+BUCKETS_PER_DECADE = 10
+
+
+def get_bucket(value):
+    """Returns the histogram bucket for a value (in seconds).
+    """
+    value = max(value, 1e-6)
+    return math.floor(math.log10(value) * BUCKETS_PER_DECADE)
+
+
+def get_bucket_value(bucket):
+    """Returns the geometric mid-point of a histogram bucket.
+    """
+    return 10 ** ((bucket + 0.5) / BUCKETS_PER_DECADE)
+
+
+def record(kind, name, value, passed=True):
+    """Adds one observation to the aggregates of (kind, name).
+    """
+    db.query(
+        "INSERT INTO stats (kind, name, count, passed, total)"
+        " VALUES ($kind, $name, 1, $passed, $value)"
+        " ON CONFLICT (kind, name) DO UPDATE SET"
+        " count = count + 1,"
+        " passed = passed + excluded.passed,"
+        " total = total + excluded.total",
+        vars={"kind": kind, "name": name, "passed": int(passed), "value": value})
+    db.query(
+        "INSERT INTO stats_histogram (kind, name, bucket, count)"
+        " VALUES ($kind, $name, $bucket, 1)"
+        " ON CONFLICT (kind, name, bucket) DO UPDATE SET count = count + 1",
+        vars={"kind": kind, "name": name, "bucket": get_bucket(value)})
+
+
+def record_task_run(site, task_name, results, durations):
+    """Records a task evaluation and each of its checks.
+
+    results: list of (validator name, CheckStatus)
+    durations: time taken by each check, in seconds
+
+    Each check is recorded by its validator and by its title, which
+    tells apart checks of the same validator with different arguments.
+    """
+    with db.transaction():
+        for (validator, check), duration in zip(results, durations):
+            db.insert("check_run",
+                      site_id=site.id,
+                      task=task_name,
+                      validator=validator,
+                      status=check.status,
+                      duration=duration)
+            record(VALIDATOR, validator, duration, check.status == "pass")
+            record(CHECK, check.title, duration, check.status == "pass")
+
+        passed = all(check.status == "pass" for _, check in results)
+        record(TASK, task_name, sum(durations), passed)
+
+
+def prune_check_runs():
+    """Deletes check runs older than config.check_run_retention_days.
+    The aggregates are not affected.
+
+    Run periodically by the evaluator workers and by
+    `python selfhosting.py prune`, not on every run.
+    """
+    db.query("DELETE FROM check_run WHERE timestamp < datetime('now', $age)",
+             vars={"age": f"-{config.check_run_retention_days} days"})
+
+
+def get_percentiles(rows, percentiles):
+    """Returns the percentiles of a histogram.
+
+    rows: histogram rows of one (kind, name), ordered by bucket
+    """
+    total = sum(row.count for row in rows)
+
+    values = []
+    for p in percentiles:
+        rank = p * total
+        seen = 0
+        for row in rows:
+            seen += row.count
+            if seen >= rank:
+                values.append(round(get_bucket_value(row.bucket), 4))
+                break
+        else:
+            values.append(None)
+    return values
+
+
+def get_summary():
+    """Returns the aggregates of all kinds, as a dict of dicts.
+    """
+    histogram_rows = db.select("stats_histogram", order="kind, name, bucket")
+    histograms = {key: list(rows)
+                  for key, rows in groupby(histogram_rows, lambda row: (row.kind, row.name))}
+
+    summary = {VALIDATOR: {}, CHECK: {}, TASK: {}, COMPLETION: {}}
+    for row in db.select("stats", order="kind, name"):
+        p50, p95 = get_percentiles(histograms.get((row.kind, row.name), []), [0.5, 0.95])
+        summary.setdefault(row.kind, {})[row.name] = {
+            "count": row.count,
+            "pass_rate": round(row.passed / row.count, 4) if row.count else None,
+            "mean": round(row.total / row.count, 4) if row.count else None,
+            "p50": p50,
+            "p95": p95,
+        }
+    return summary
+
+
+class CheckCosts:
+    """Exponential moving averages of latency and failure rate per check,
+    keyed by the title of the check (str(check)).
+
+    The averages start from the saved aggregates of each check (see
+    `load`), and from the defaults for checks that have never run.
+    """
+    # weight of the latest observation
+    ALPHA = 0.2
+
+    # assumed for validators that haven't been observed yet
+    DEFAULT_LATENCY = 0.5
+    DEFAULT_FAILURE_RATE = 0.5
+
+    def __init__(self):
+        self._latency = {}
+        self._failure_rate = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Starts the averages from the aggregates in the stats table, once
+        per process.
+        """
+        with self._lock:
+            if self._loaded:
+                return
+            rows = db.select("stats", where="kind=$kind and count > 0", vars={"kind": CHECK})
+            for row in rows:
+                self._latency.setdefault(row.name, row.total / row.count)
+                self._failure_rate.setdefault(row.name, 1 - row.passed / row.count)
+            self._loaded = True
+
+    def observe(self, check, latency, passed):
+        self.load()
+        a = self.ALPHA
+        self._latency[check] = (
+            a * latency + (1 - a) * self._latency.get(check, latency))
+        failed = 0.0 if passed else 1.0
+        self._failure_rate[check] = (
+            a * failed + (1 - a) * self._failure_rate.get(check, self.DEFAULT_FAILURE_RATE))
+
+    def get_score(self, check):
+        """Expected time spent per failure found by this check.
+        Running checks in increasing order of it finds a failure soonest.
+        """
+        latency = self._latency.get(check, self.DEFAULT_LATENCY)
+        failure_rate = self._failure_rate.get(check, self.DEFAULT_FAILURE_RATE)
+        return latency / max(failure_rate, 0.01)
+
+    def order(self, checks):
+        """Returns indices of checks in the order they should be run.
+        Ties keep the given order.
+        """
+        self.load()
+        return sorted(range(len(checks)), key=lambda i: self.get_score(checks[i]))
+
+
+check_costs = CheckCosts()
@@ -1,10 +1,10 @@
 from __future__ import annotations
 
+import functools
+from collections import Counter
 from dataclasses import dataclass
 from typing import Callable, Dict, List, Optional
 
-import yaml
-
 from .db import Site
 from .form import Form, create_form
 
@@ -28,6 +28,13 @@ class CheckStatus:
         self.message = message
         return self
 
+    def skip(self):
+        """Marks the check as not run, as the task had already failed.
+        """
+        self.status = "skipped"
+        self.message = ""
+        return self
+
 
 class ValidationError(Exception):
     pass
@@ -73,6 +80,9 @@ class Task:
     checks: List[Validator]
     form: Optional[Form] = None
     actions: Optional[List[Action]] = None
+    # names of the tasks that must pass before this task is evaluated.
+    # When not specified in the tasks file, it is the previous task.
+    depends_on: Optional[List[str]] = None
 
     def run_actions(self, site):
         for action in self.actions:
@@ -87,11 +97,10 @@ class TaskParser:
     def load_from_file(self, filename) -> List[Task]:
         """Loads a list of tasks from a file.
         """
-        with open(filename) as f:
-            data = yaml.safe_load(f)
-
-        tasks = data['tasks']
-        return [self.from_dict(t) for t in tasks]
+        data = load_yaml(filename)
+        tasks = [self.from_dict(t) for t in data['tasks']]
+        self.resolve_dependencies(tasks)
+        return tasks
 
     def from_dict(self, data) -> Task:
         """Loads a Task from dict.
@@ -102,6 +111,9 @@ class TaskParser:
         checks = [self.parse_check(c) for c in data['checks']]
         form = (form_data := data.get('form')) and create_form(name, form_data)
         actions = [get_action(action_name) for action_name in data.get('actions', [])]
+        depends_on = data.get('depends_on')
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
         return Task(
             name=name,
             title=title,
@@ -109,8 +121,38 @@ class TaskParser:
             checks=checks,
             form=form,
             actions=actions,
+            depends_on=depends_on,
         )
 
+    def resolve_dependencies(self, tasks: List[Task]):
+        """Fills in the default dependencies and validates that the
+        dependencies of the tasks form a DAG.
+
+        Raises ValueError on duplicate or unknown task names and on cycles.
+        """
+        names = [task.name for task in tasks]
+        duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+        if duplicates:
+            raise ValueError(f"Duplicate task names: {', '.join(duplicates)}")
+
+        for i, task in enumerate(tasks):
+            if task.depends_on is None:
+                task.depends_on = names[i-1:i]
+            for name in task.depends_on:
+                if name not in names:
+                    raise ValueError(f"Task {task.name} depends on unknown task: {name}")
+
+        # Kahn's algorithm: repeatedly take out the tasks with no pending dependencies
+        pending = {task.name: set(task.depends_on) for task in tasks}
+        while pending:
+            done = [name for name, deps in pending.items() if not deps]
+            if not done:
+                raise ValueError(f"Cyclic dependencies between tasks: {', '.join(pending)}")
+            for name in done:
+                del pending[name]
+            for deps in pending.values():
+                deps.difference_update(done)
+
     def parse_check(self, check_data):
         if isinstance(check_data, str):
             return self.validators[check_data]()
@@ -122,6 +164,18 @@ class TaskParser:
             raise ValueError(f"Invalid check: {check_data}")
 
 
+@functools.lru_cache(maxsize=None)
+def load_yaml(path):
+    """Loads a YAML file, parsing it only once.
+
+    The returned value is shared, so it must not be modified.
+    """
+    import yaml
+
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
 _actions: Dict[str, Action] = {}
 
 
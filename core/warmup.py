@@ -0,0 +1,45 @@
+"""Warming up a worker before it takes traffic.
+
+Templates are compiled to bytecode once and kept in a cache directory
+shared by all workers, so that a new worker only has to load them. The
+warm-up also loads the course and renders its markdown, which would
+otherwise be done by the first requests.
+"""
+import os
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache that writes files atomically, so that
+    workers starting together never read a partially written file.
+    """
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory)
+
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def warm_up(app, treadmill):
+    """Compiles all templates and loads the course and its markdown.
+    """
+    from .webapp import markdown_to_html
+
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+    for task in treadmill.get_tasks():
+        markdown_to_html(task.description)
+        if task.form:
+            markdown_to_html(task.form.description)
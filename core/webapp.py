@@ -1,21 +1,42 @@
 import functools
+import hmac
+import os
 from dataclasses import asdict
 
-import markdown
 import web
-from flask import Flask, abort, flash, g, jsonify, redirect, render_template, request, url_for
-from jinja2 import Markup
+from flask import (
+    Flask, Response, abort, flash, g, jsonify, redirect, render_template, request,
+    stream_with_context, url_for,
+)
+from markupsafe import Markup
 
 from . import config
+from . import export
 from . import form
+from . import stats
+from .assets import Assets
 from .auth import Github, login_user, logout_user, get_logged_in_user
-from .db import User
+from .db import SiteLease, User, get_progress_matrix, iter_task_statuses
+from .profiling import get_profiler
+from .warmup import SharedBytecodeCache
+from .ratelimit import Coalescer, RateLimiter
 from .tasks import TaskStatus
 
 
 app = Flask(__name__)
 app.secret_key = config.secret_key
 
+if config.cache_dir:
+    app.jinja_env.bytecode_cache = SharedBytecodeCache(os.path.join(config.cache_dir, "jinja"))
+
+assets = Assets(app, os.path.join(os.path.dirname(__file__), "static"))
+
+refresh_site_limiter = RateLimiter(config.refresh_site_limit[0] / 60, config.refresh_site_limit[1])
+refresh_client_limiter = RateLimiter(config.refresh_client_limit[0] / 60, config.refresh_client_limit[1])
+refresh_coalescer = Coalescer()
+
+profiler = get_profiler()
+
 
 def get_github():
     redirect_uri = url_for("github_callback", _external=True)
@@ -31,16 +52,54 @@ def auth_required(func):
     return wrapper
 
 
+def instructor_required(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not g.user:
+            return redirect(url_for("login"))
+        if not is_instructor(g.user):
+            abort(403)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def is_instructor(user):
+    return user is not None and user.username in config.instructors
+
+
 @app.template_filter()
+@functools.lru_cache(maxsize=1024)
 def markdown_to_html(md):
+    import markdown
     return Markup(markdown.markdown(md))
 
 
+@app.before_request
+def start_profiling():
+    if not profiler.enabled:
+        return
+
+    token = request.headers.get("X-Profile", "")
+    force = bool(config.profile_token) and hmac.compare_digest(token, config.profile_token)
+    g.profile_session = profiler.start(force=force)
+
+
 @app.before_request
 def before_request():
+    # assets are the same for everyone; reading the session would add
+    # "Vary: Cookie" to them and keep them out of shared caches
+    if request.endpoint == "asset":
+        g.user = None
+        return
     g.user = get_logged_in_user()
 
 
+@app.teardown_request
+def stop_profiling(exc):
+    if (session := g.pop("profile_session", None)):
+        profiler.stop(session, f"{request.method}-{request.endpoint}")
+
+
 @app.context_processor
 def update_context():
     return {
@@ -49,6 +108,7 @@ def update_context():
         "subtitle": g.treadmill.subtitle,
         "current_user": g.user,
         "make_input_html": form.make_input_html,
+        "is_instructor": is_instructor(g.user),
     }
 
 
@@ -66,6 +126,68 @@ def leaderboard():
     return render_template("leaderboard.html", sites=sites)
 
 
+@app.route("/instructor")
+@instructor_required
+def instructor():
+    """Renders progress of all sites, as a table of sites x tasks.
+
+    Query parameters:
+      task: show only sites that are working on this task, or that have
+            it in status if given
+      status: show only sites with a task in this status: pass, fail,
+              locked or current
+      page: page number, starting from 1
+    """
+    tasks = g.treadmill.get_tasks()
+    task_filter = request.args.get("task") or None
+    status_filter = request.args.get("status") or None
+    page = request.args.get("page", 1, type=int)
+    page_size = 50
+
+    sites = get_progress_matrix()
+    if task_filter:
+        task = g.treadmill.get_task(task_filter)
+        if not task:
+            sites = []
+        elif status_filter:
+            sites = [s for s in sites if s.has_status(task, status_filter)]
+        else:
+            sites = [s for s in sites if s.is_current(task)]
+    elif status_filter:
+        sites = [s for s in sites if any(s.has_status(t, status_filter) for t in tasks)]
+
+    pages = max(1, (len(sites) + page_size - 1) // page_size)
+    page = min(max(page, 1), pages)
+    offset = (page - 1) * page_size
+
+    return render_template(
+        "instructor.html",
+        tasks=tasks,
+        sites=sites[offset:offset + page_size],
+        total=len(sites),
+        page=page,
+        pages=pages,
+        task_filter=task_filter,
+        status_filter=status_filter,
+    )
+
+
+@app.route("/instructor/export.<format>")
+@instructor_required
+def instructor_export(format):
+    """Streams the status of every task of every site as CSV or NDJSON.
+    """
+    if format not in export.EXPORTERS:
+        abort(404)
+    exporter, mimetype = export.EXPORTERS[format]
+    chunks = exporter(iter_task_statuses())
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=progress.{format}"},
+    )
+
+
 @app.route("/dashboard", methods=["GET", "POST"])
 @auth_required
 def dashboard():
@@ -74,6 +196,7 @@ def dashboard():
     `tasks` given to the template is a list of dict.
 
     task.status can be either of "pass", "fail", "current", "locked".
+    All the tasks that are ready to be worked on are "current".
     """
     site = g.treadmill.get_site(g.user.username)
     if not site:
@@ -104,9 +227,13 @@ def dashboard():
         raw_tasks = g.treadmill.get_tasks()
         tasks = []
 
+        task_statuses = site.get_task_statuses()
+        frontier = g.treadmill.get_frontier(
+            {name: s.status for name, s in task_statuses.items()})
+
         for raw_task in raw_tasks:
             task = asdict(raw_task)
-            task_status = site.get_task_status(task["name"])
+            task_status = task_statuses.get(raw_task.name)
             task["status"] = task_status.status if task_status else "locked"
             task["checks"] = task_status.checks if task_status else []
 
@@ -114,7 +241,7 @@ def dashboard():
             if form_values:
                 task["form"]["values"] = form_values
 
-            if task["name"] == site.current_task:
+            if task["name"] == site.current_task or task["name"] in frontier:
                 task["status"] = "current"
 
             tasks.append(task)
@@ -127,15 +254,51 @@ def dashboard():
 
 
 @app.route("/site/<name>/refresh", methods=["POST"])
+@auth_required
 def site_refresh(name):
     """Refresh status of site (re-run deployment or checks)
+
+    Only the owner of the site and instructors can refresh it, so that
+    nobody else can use up the site's refresh limit. Concurrent requests
+    for the same site share one evaluation. Requests over the per-site
+    or per-user limit get a 429 with the last saved status.
     """
     site = g.treadmill.get_site(name)
     if not site:
         abort(404)
+    if g.user.username != site.name and not is_instructor(g.user):
+        abort(403)
+
+    allowed, wait_time = refresh_client_limiter.check(g.user.username)
+    if allowed:
+        if (running := refresh_coalescer.get_running(name)):
+            return jsonify(running.result())
+        allowed, wait_time = refresh_site_limiter.check(name)
+
+    if not allowed:
+        response = jsonify(site.get_status())
+        response.status_code = 429
+        response.headers["Retry-After"] = str(max(1, round(wait_time)))
+        return response
+
+    status = refresh_coalescer.run(name, refresh_site, site)
+    return jsonify(status)
+
+
+def refresh_site(site):
     status = g.treadmill.get_status(site)
     site.update_status(status)
-    return jsonify(status)
+    SiteLease.mark_evaluated(site)
+    return status
+
+
+@app.route("/stats")
+@instructor_required
+def check_stats():
+    """Aggregate statistics of check runs: pass rate and p50/p95 latency
+    per validator, per check and per task, and time-to-complete per task.
+    """
+    return jsonify(stats.get_summary())
 
 
 @app.route("/auth/github")
@@ -158,11 +321,10 @@ def github_callback():
     token = gh.get_access_token(code)
     username = gh.get_username(token)
 
-    user = User.find(username=username) or User.create(username=username)
+    user = User.find_or_create(username=username)
+    g.treadmill.get_or_create_site(user.username)
     login_user(user)
 
-    g.treadmill.get_site(user.username) or g.treadmill.new_site(user.username)
-
     flash(f"Welcome to Self Hosting 101, {user.username}", "info")
     return redirect(url_for("index"))
 
@@ -0,0 +1,135 @@
+"""Evaluator workers.
+
+A worker evaluates sites outside of web requests. Sites are split into
+shards by id, and each worker takes the sites of one shard that are due
+for evaluation, claiming each one with a lease in the database before
+evaluating it. Any number of workers can run, on any number of hosts;
+a lease that isn't released, because its worker crashed, expires after
+`lease_duration` seconds.
+
+Workers evaluate a site no more often than the per-site refresh limit
+allows (config.refresh_site_limit), and a refresh from the web app
+counts as an evaluation, see SiteLease.mark_evaluated.
+
+Workers also prune the check history every `prune_interval` seconds.
+"""
+import multiprocessing
+import os
+import socket
+import time
+
+from . import config, stats
+from .db import SiteLease
+
+
+class EvaluatorWorker:
+    def __init__(self, treadmill, shard=0, shards=1,
+                 interval=60, lease_duration=300, report_interval=60,
+                 prune_interval=3600):
+        """Worker instance.
+
+        treadmill: Treadmill with the course to evaluate
+        shard, shards: the worker takes the sites with id % shards == shard
+        interval: minimum seconds between two evaluations of a site,
+                  raised to the interval of the per-site refresh limit
+        lease_duration: seconds a site stays claimed, should be longer
+                        than an evaluation
+        report_interval: seconds between throughput reports
+        prune_interval: seconds between deleting old check runs
+        """
+        self.treadmill = treadmill
+        self.shard = shard
+        self.shards = shards
+        self.interval = max(interval, 60 / config.refresh_site_limit[0])
+        self.lease_duration = lease_duration
+        self.report_interval = report_interval
+        self.prune_interval = prune_interval
+
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._evaluated = 0
+        self._failed = 0
+        self._busy_time = 0.0
+        self._report_start = time.monotonic()
+        self._last_prune = None
+
+    def __str__(self):
+        return f"worker {self.id} shard {self.shard}/{self.shards}"
+
+    def run(self):
+        print(f"[{self}] started")
+        while True:
+            if not self.run_once():
+                time.sleep(min(5, self.interval))
+            self.report()
+            self.prune()
+
+    def run_once(self):
+        """Evaluates a batch of due sites. Returns the number evaluated.
+        """
+        names = SiteLease.find_due(self.shard, self.shards, self.interval)
+        count = 0
+        for name in names:
+            site = self.treadmill.get_site(name)
+            if site and SiteLease.claim(site, self.id, self.lease_duration):
+                self.evaluate(site)
+                count += 1
+        return count
+
+    def evaluate(self, site):
+        start = time.monotonic()
+        try:
+            status = self.treadmill.get_status(site)
+            site.update_status(status)
+            self._evaluated += 1
+        except Exception as e:
+            print(f"[{self}] failed to evaluate {site.name}: {e}")
+            self._failed += 1
+        finally:
+            SiteLease.release(site, self.id)
+            self._busy_time += time.monotonic() - start
+
+    def prune(self):
+        now = time.monotonic()
+        if self._last_prune is not None and now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        try:
+            stats.prune_check_runs()
+        except Exception as e:
+            print(f"[{self}] failed to prune check runs: {e}")
+
+    def report(self, force=False):
+        elapsed = time.monotonic() - self._report_start
+        if elapsed < self.report_interval and not force:
+            return
+
+        rate = self._evaluated * 60 / elapsed
+        utilization = self._busy_time * 100 / elapsed
+        print(f"[{self}] {self._evaluated} sites evaluated, {self._failed} failed"
+              f" in {elapsed:.0f}s: {rate:.1f} sites/min, {utilization:.0f}% busy")
+
+        self._evaluated = self._failed = 0
+        self._busy_time = 0.0
+        self._report_start = time.monotonic()
+
+
+def run_workers(target, processes, shards, shard_offset=0):
+    """Runs `processes` worker processes and waits for them.
+
+    Process i is given the shard (shard_offset + i) % shards, so workers
+    on different hosts can be given different offsets. `target` is called
+    in each process as target(shard, shards).
+    """
+    if processes == 1:
+        target(shard_offset % shards, shards)
+        return
+
+    workers = [
+        multiprocessing.Process(target=target, args=((shard_offset + i) % shards, shards))
+        for i in range(processes)
+    ]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
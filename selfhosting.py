@@ -1,13 +1,31 @@
+import functools
 import os
 
-import digitalocean
-import requests
-
-from core import Treadmill, ValidationError, Validator
+from core import Treadmill, ValidationError, Validator, export
+from core.db import iter_task_statuses
+from core.dns import DigitalOceanProvider, DNSSync
+from core.profiling import get_profiler
 from core.tasks import register_action
-from core.webapp import app
 
-tm = Treadmill(app, "tasks.yml")
+# The webapp is attached on first use of `app`, so that CLI commands
+# don't pay for importing flask.
+tm = Treadmill(None, "tasks.yml")
+
+
+def get_app():
+    from core.warmup import warm_up
+    from core.webapp import app
+
+    if not tm.is_attached(app):
+        tm.init_app(app)
+        warm_up(app, tm)
+    return app
+
+
+def __getattr__(name):
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @tm.validator
@@ -20,6 +38,8 @@ class check_http_status(Validator):
         return f"Check HTTP status: {self.url} [{self.expected_status}]"
 
     def validate(self, site):
+        import requests
+
         url = site.base_url + self.url
         r = requests.get(url)
         if str(r.status_code) != str(self.expected_status):
@@ -38,6 +58,8 @@ class check_package_exists(Validator):
         return f"Check package exists: {self.package}"
 
     def validate(self, site):
+        import requests
+
         r = requests.get(f"{site.base_url}/packages/{self.package}")
         print("status: ", r.status_code)
         print(r.json())
@@ -54,6 +76,8 @@ class check_file_exists(Validator):
         return f"Check file exists: {self.path}"
 
     def validate(self, app):
+        import requests
+
         r = requests.get(f"{app.base_url}/{self.path}")
         if r.status_code != 200:
             raise ValidationError(f"File {self.path} does not exist")
@@ -68,6 +92,8 @@ class check_user_exists(Validator):
         return f"Check user exists: {self.user}"
 
     def validate(self, app):
+        import requests
+
         r = requests.get(f"{app.base_url}/users")
         r.raise_for_status()
 
@@ -83,22 +109,25 @@ def add_dns_entry(site, task):
     form_values = task.form.get_current_values(site)
     ip_address = form_values["ip"]
 
-    token = os.environ["DIGITALOCEAN_TOKEN"]
-    base_domain = tm.config["base_domain"]
+    get_dns_sync().set_record(site.name, ip_address)
+
+
+_dns_sync = None
 
-    domain = digitalocean.Domain(token=token, name=base_domain)
-    for record in domain.get_records():
-        if record.name == site.name:
-            record.data = ip_address
-            record.save()
-            break
-    else:
-        domain.create_new_domain_record(
-            type="A",
-            name=site.name,
-            data=ip_address,
-            ttl="120"  # 2 mins, for easy debugging
-        )
+
+def get_dns_sync():
+    global _dns_sync
+    if _dns_sync is None:
+        token = os.environ["DIGITALOCEAN_TOKEN"]
+        base_domain = tm.config["base_domain"]
+        _dns_sync = DNSSync(DigitalOceanProvider(token, base_domain))
+    return _dns_sync
+
+
+def run_worker(shard, shards, interval=60):
+    from core.worker import EvaluatorWorker
+
+    EvaluatorWorker(tm, shard=shard, shards=shards, interval=interval).run()
 
 
 def main():
@@ -107,7 +136,7 @@ def main():
     cmd = sys.argv[1] if len(sys.argv) > 1 else "run"
 
     if cmd == "run":
-        app.run(debug=True)
+        get_app().run(debug=True)
 
     elif cmd == "new":
         site_name = sys.argv[2]
@@ -120,10 +149,45 @@ def main():
         if not site:
             print(f"Site not found: {site_name}")
             sys.exit(1)
-        status = tm.get_status(site)
+        with get_profiler().profile(f"check-{site_name}"):
+            status = tm.get_status(site, full=True)
         print(status)
         site.update_status(status)
 
+    elif cmd == "worker":
+        import argparse
+
+        from core.worker import run_workers
+
+        p = argparse.ArgumentParser(prog="selfhosting.py worker",
+                                    description="Evaluate sites continuously")
+        p.add_argument("--processes", type=int, default=1,
+                       help="number of worker processes to run on this host")
+        p.add_argument("--shards", type=int,
+                       help="total number of shards across all hosts (default: processes)")
+        p.add_argument("--shard-offset", type=int, default=0,
+                       help="shard of the first process on this host")
+        p.add_argument("--interval", type=float, default=60,
+                       help="minimum seconds between two evaluations of a site")
+        args = p.parse_args(sys.argv[2:])
+
+        target = functools.partial(run_worker, interval=args.interval)
+        run_workers(target, args.processes, args.shards or args.processes, args.shard_offset)
+
+    elif cmd == "prune":
+        from core import stats
+
+        stats.prune_check_runs()
+
+    elif cmd == "export":
+        format = sys.argv[2] if len(sys.argv) > 2 else "csv"
+        if format not in export.EXPORTERS:
+            print(f"invalid format: {format}, expected one of: {', '.join(export.EXPORTERS)}")
+            sys.exit(1)
+        exporter, _ = export.EXPORTERS[format]
+        for chunk in exporter(iter_task_statuses()):
+            sys.stdout.write(chunk)
+
     else:
         print("invalid command: ", cmd)
         sys.exit(1)
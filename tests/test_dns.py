@@ -0,0 +1,106 @@
+from collections import Counter
+
+from core.dns import DNSRecord, DNSSync, InMemoryProvider
+
+
+class CountingProvider(InMemoryProvider):
+    def __init__(self, records=None):
+        self.calls = Counter()
+        self.failures = 0  # number of creates to fail
+        super().__init__(records)
+        self.calls.clear()
+
+    def list_records(self):
+        self.calls["list"] += 1
+        return super().list_records()
+
+    def create_record(self, record):
+        self.calls["create"] += 1
+        if self.failures:
+            self.failures -= 1
+            raise IOError("service unavailable")
+        return super().create_record(record)
+
+    def update_record(self, record):
+        self.calls["update"] += 1
+        super().update_record(record)
+
+
+def get_data(provider, name):
+    return {r.name: r.data for r in provider.records.values()}.get(name)
+
+
+def queue(sync, name, data):
+    # set_record starts the background thread; flush directly instead
+    with sync._lock:
+        sync._pending[name] = DNSRecord(name=name, data=data)
+
+
+def test_batch_lists_zone_once():
+    provider = CountingProvider([DNSRecord("existing", "1.1.1.1")])
+    sync = DNSSync(provider)
+
+    for i in range(10):
+        queue(sync, f"site{i}", f"10.0.0.{i}")
+    queue(sync, "existing", "1.1.1.1")
+    sync.flush()
+
+    assert provider.calls == Counter(list=1, create=10)
+    assert get_data(provider, "site3") == "10.0.0.3"
+
+
+def test_unchanged_record_rechecked_once_per_flush():
+    provider = CountingProvider([DNSRecord("alice", "1.1.1.1")])
+    sync = DNSSync(provider)
+    sync.get_record("alice")
+
+    # changed by another process since the index was loaded
+    record = next(iter(provider.records.values()))
+    record.data = "2.2.2.2"
+
+    queue(sync, "alice", "1.1.1.1")
+    sync.flush()
+    assert get_data(provider, "alice") == "1.1.1.1"
+
+    queue(sync, "alice", "1.1.1.1")
+    sync.flush()
+    assert provider.calls == Counter(list=3, update=1)
+
+
+def test_failed_change_is_retried():
+    provider = CountingProvider()
+    provider.failures = 1
+    sync = DNSSync(provider)
+
+    queue(sync, "bob", "3.3.3.3")
+    sync.flush()
+    assert get_data(provider, "bob") is None
+    assert "bob" in sync._pending
+
+    # not due yet
+    sync.flush()
+    assert get_data(provider, "bob") is None
+
+    sync.flush(force=True)
+    assert get_data(provider, "bob") == "3.3.3.3"
+    assert not sync._pending
+
+
+def test_failed_change_keeps_newer_value():
+    provider = CountingProvider()
+    provider.failures = 1
+    sync = DNSSync(provider)
+
+    queue(sync, "carol", "4.4.4.4")
+    original = provider.create_record
+
+    def create_record(record):
+        # a newer value is queued while the first one is being applied
+        queue(sync, "carol", "5.5.5.5")
+        provider.create_record = original
+        return original(record)
+
+    provider.create_record = create_record
+    sync.flush()
+    sync.flush(force=True)
+    assert get_data(provider, "carol") == "5.5.5.5"